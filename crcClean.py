@@ -1,137 +1,334 @@
 import argparse
+import hashlib
+import os
 import re
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 
 DATA_DIR = Path(__file__).resolve().parent / "GDC_download"
+CACHE_DIR_NAME = ".parse_cache"
+# Part of every cache key; bump whenever a parser's output changes so stale
+# entries from older code are ignored.
+CACHE_VERSION = 3
+
+TCGA_ID_PATTERN = re.compile(r"(TCGA-[A-Z0-9-]+)")
+UUID_PATTERN = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+)
+
+# (sample_id, feature names, values) for a single parsed file.
+SampleFeatures = tuple[str, np.ndarray, np.ndarray]
 
 
 def extract_sample_id(path: Path) -> str:
     """Extract sample or aliquot identifier from a file path."""
 
     name = path.name
-    m = re.search(r"(TCGA-[A-Z0-9-]+)", name)
+    m = TCGA_ID_PATTERN.search(name)
     if m:
         return m.group(1)
-    m = re.search(
-        r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", name
-    )
+    m = UUID_PATTERN.search(name)
     if m:
         return m.group(0)
     return path.stem
 
 
-def parse_mirna_quant(path: Path) -> pd.DataFrame:
-    """Parse miRNA quantification file into wide format.
+def iter_data_files(data_dir: Path):
+    """Yield tabular data files (.txt/.tsv) below ``data_dir``.
+
+    Suffixes are checked on the raw names from os.walk so Path objects are
+    only built for matching files; the parse cache directory is skipped.
+    """
+
+    for root, dirs, names in os.walk(data_dir):
+        if CACHE_DIR_NAME in dirs:
+            dirs.remove(CACHE_DIR_NAME)
+        for name in names:
+            if name.lower().endswith((".txt", ".tsv")):
+                yield Path(root, name)
+
+
+def read_columns(path: Path) -> list[str]:
+    """Return the header of a tab-separated file without parsing its rows."""
+
+    with path.open() as fh:
+        return fh.readline().rstrip("\r\n").split("\t")
+
+
+def read_tsv(path: Path, column_types: dict[str, pa.DataType]) -> pa.Table:
+    """Read only the given columns of a tab-separated file into an Arrow table.
+
+    Skips pandas entirely; the parsers only need a couple of flat arrays.
+    Blank string cells come back as nulls so parsers can drop them.
+    """
+
+    return pacsv.read_csv(
+        path,
+        parse_options=pacsv.ParseOptions(delimiter="\t"),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=list(column_types),
+            column_types=column_types,
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def prefixed(prefix: str, column: pa.ChunkedArray) -> np.ndarray:
+    """Prefix every value of a string column, returning an object array."""
+
+    return pc.binary_join_element_wise(prefix, column, "").to_numpy()
+
+
+def parse_mirna_quant(path: Path) -> SampleFeatures:
+    """Parse miRNA quantification file into per-miRNA RPM values.
 
     Multiple rows can exist per miRNA (e.g., isoforms). Values are summed so
     that each miRNA appears once per sample.
     """
 
-    df = pd.read_csv(path, sep="\t")
+    columns = read_columns(path)
     rpm_column_options = [
         "reads_per_million_miRNA_mapped",
         "reads_per_million_mirna_mapped",
         "RPM",
     ]
-    rpm_column = next((c for c in rpm_column_options if c in df.columns), None)
+    rpm_column = next((c for c in rpm_column_options if c in columns), None)
     if rpm_column is None:
         raise ValueError(f"RPM column not found in {path.name}")
 
-    df = df[["miRNA_ID", rpm_column]].rename(columns={rpm_column: "RPM"})
-    collapsed = df.groupby("miRNA_ID", as_index=False)["RPM"].sum()
-    wide = collapsed.set_index("miRNA_ID").T
-    wide.index = [extract_sample_id(path)]
-    wide.columns = [f"mirna__{c}" for c in wide.columns]
-    return wide
+    table = read_tsv(path, {"miRNA_ID": pa.string(), rpm_column: pa.float32()})
+    collapsed = table.group_by("miRNA_ID").aggregate([(rpm_column, "sum")])
+    collapsed = collapsed.filter(pc.is_valid(collapsed["miRNA_ID"]))
+    collapsed = collapsed.sort_by("miRNA_ID")
+    features = prefixed("mirna__", collapsed["miRNA_ID"])
+    values = collapsed[f"{rpm_column}_sum"].to_numpy().astype(np.float32)
+    return extract_sample_id(path), features, values
 
 
-def parse_rppa(path: Path) -> pd.DataFrame:
-    """Parse RPPA data file into wide format."""
+def parse_rppa(path: Path) -> SampleFeatures:
+    """Parse RPPA data file into per-target protein expression values."""
 
-    df = pd.read_csv(path, sep="\t")
-    df = df[["peptide_target", "protein_expression"]]
-    wide = df.set_index("peptide_target").T
-    wide.index = [extract_sample_id(path)]
-    wide.columns = [f"rppa__{c}" for c in wide.columns]
-    return wide
+    table = read_tsv(
+        path, {"peptide_target": pa.string(), "protein_expression": pa.float32()}
+    )
+    table = table.filter(pc.is_valid(table["peptide_target"]))
+    features = prefixed("rppa__", table["peptide_target"])
+    return extract_sample_id(path), features, table["protein_expression"].to_numpy()
 
 
-def parse_seg(path: Path) -> pd.DataFrame | None:
+def parse_seg(path: Path) -> SampleFeatures | None:
     """Parse segmentation file and summarize by chromosome."""
 
-    df = pd.read_csv(path, sep="\t")
-    if "Chromosome" not in df.columns:
+    columns = read_columns(path)
+    if "Chromosome" not in columns:
         return None
 
-    chromosome = df["Chromosome"].astype(str).str.replace("chr", "", regex=False)
-    df = df.assign(Chromosome=chromosome)
-
-    if "Segment_Mean" in df.columns:
-        agg = df.groupby("Chromosome")["Segment_Mean"].mean()
-    elif "Copy_Number" in df.columns:
-        agg = df.groupby("Chromosome")["Copy_Number"].mean()
+    if "Segment_Mean" in columns:
+        value_column = "Segment_Mean"
+    elif "Copy_Number" in columns:
+        value_column = "Copy_Number"
     else:
         return None
 
-    agg.index = [f"seg__chr{c}" for c in agg.index]
-    result = agg.to_frame().T
-    result.index = [extract_sample_id(path)]
-    return result
+    # Chromosome is decoded straight into a dictionary column, so the "chr"
+    # prefix is stripped on the ~25 distinct names instead of every segment.
+    table = read_tsv(
+        path,
+        {
+            "Chromosome": pa.dictionary(pa.int32(), pa.string()),
+            value_column: pa.float32(),
+        },
+    )
+    encoded = table["Chromosome"].unify_dictionaries().combine_chunks()
+    names = pc.replace_substring(encoded.dictionary, "chr", "").to_numpy(
+        zero_copy_only=False
+    )
+    chromosomes, remap = np.unique(names, return_inverse=True)
+    codes = np.append(remap, -1)[pc.fill_null(encoded.indices, len(names)).to_numpy()]
+    values = table[value_column].to_numpy()
+
+    # Per-chromosome mean via bincount; skips the GroupBy machinery, which
+    # dominates on files of a few thousand segments.
+    valid = (codes >= 0) & ~np.isnan(values)
+    sums = np.bincount(codes[valid], weights=values[valid], minlength=len(chromosomes))
+    counts = np.bincount(codes[valid], minlength=len(chromosomes))
+    with np.errstate(invalid="ignore"):
+        means = sums / counts
+
+    features = np.array([f"seg__chr{c}" for c in chromosomes], dtype=object)
+    return extract_sample_id(path), features, means.astype(np.float32)
+
+
+def parse_cached(
+    parser: Callable[[Path], SampleFeatures | None], path: Path, cache_dir: Path
+) -> SampleFeatures | None:
+    """Run ``parser`` on ``path``, reusing a Parquet copy of a previous parse.
+
+    Cache entries are keyed by CACHE_VERSION, parser, path and modification
+    time, so an edited or replaced file is parsed again. Unreadable entries
+    are discarded and re-parsed, and a failed cache write never loses the
+    parsed result.
+    """
+
+    stat = path.stat()
+    key = hashlib.blake2b(
+        f"{CACHE_VERSION}:{parser.__name__}:{path}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:16]
+    cache_path = cache_dir / f"{key}.parquet"
+    if cache_path.exists():
+        try:
+            cached = pd.read_parquet(cache_path)
+            return (
+                extract_sample_id(path),
+                cached["feature"].to_numpy(dtype=object),
+                cached["value"].to_numpy(),
+            )
+        except Exception:
+            cache_path.unlink(missing_ok=True)
+
+    parsed = parser(path)
+    if parsed is not None:
+        _, features, values = parsed
+        # Write to a temporary file and rename it into place so an interrupted
+        # run never leaves a truncated entry behind.
+        tmp_path = None
+        try:
+            fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            os.close(fd)
+            tmp_path = Path(tmp_name)
+            pd.DataFrame({"feature": features, "value": values}).to_parquet(
+                tmp_path, index=False
+            )
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not cache {path}: {e}")
+            if tmp_path is not None:
+                tmp_path.unlink(missing_ok=True)
+    return parsed
+
+
+def pivot_samples(records: list[SampleFeatures]) -> pd.DataFrame:
+    """Combine parsed sample records into a samples x features frame.
+
+    The feature union is computed once, in first-seen order, and each record
+    is scattered into a preallocated array, rather than concatenating one wide
+    frame per file.
+    Sample IDs are expected to be unique; collect_data dedups before parsing.
+    """
+
+    union = pd.Index(pd.unique(np.concatenate([feats for _, feats, _ in records])))
+    values = np.full((len(records), len(union)), np.nan, dtype=np.float32)
+    for row, (_, feats, vals) in enumerate(records):
+        values[row, union.get_indexer(feats)] = vals
+
+    return pd.DataFrame(
+        values, index=[sample_id for sample_id, _, _ in records], columns=union
+    )
+
 
+def collect_data(
+    data_dir: Path = DATA_DIR, use_cache: bool = True, verbose: bool = False
+) -> pd.DataFrame:
+    """Iterate through the download directory and consolidate data.
 
-def collect_data(data_dir: Path = DATA_DIR) -> pd.DataFrame:
-    """Iterate through the download directory and consolidate data."""
+    Parsed files are cached as Parquet under ``data_dir / CACHE_DIR_NAME`` so
+    reruns skip CSV parsing unless ``use_cache`` is False. With ``verbose``,
+    the matched files are listed before parsing.
+    """
 
     data_dir = data_dir.expanduser().resolve()
     if not data_dir.exists():
         print(f"Data directory not found: {data_dir}")
         return pd.DataFrame()
 
-    mirna_frames: list[pd.DataFrame] = []
-    rppa_frames: list[pd.DataFrame] = []
-    seg_frames: list[pd.DataFrame] = []
-
-    for f in data_dir.rglob("*"):
-        if f.suffix.lower() not in {".txt", ".tsv"}:
-            continue
+    mirna_records: list[SampleFeatures] = []
+    rppa_records: list[SampleFeatures] = []
+    seg_records: list[SampleFeatures] = []
+    buckets = {"mirna": mirna_records, "rppa": rppa_records, "seg": seg_records}
+    parsers = {"mirna": parse_mirna_quant, "rppa": parse_rppa, "seg": parse_seg}
+
+    # Files are grouped per modality and sample; only the first file for a
+    # sample is parsed up front, and later duplicates are read only if it
+    # fails or yields nothing.
+    candidates: dict[tuple[str, str], list[Path]] = {}
+    for f in iter_data_files(data_dir):
         name = f.name.lower()
+        if "quantification" in name and "mirbase21" in name:
+            cat = "mirna"
+        elif "rppa" in name:
+            cat = "rppa"
+        elif "seg" in name:
+            cat = "seg"
+        else:
+            continue
+        candidates.setdefault((cat, extract_sample_id(f)), []).append(f)
+
+    if verbose:
+        sys.stdout.write(
+            "".join(f" - {f}\n" for paths in candidates.values() for f in paths)
+        )
+
+    if use_cache:
+        cache_dir = data_dir / CACHE_DIR_NAME
         try:
-            if "quantification" in name and "mirbase21" in name:
-                mirna_frames.append(parse_mirna_quant(f))
-            elif "rppa" in name:
-                rppa_frames.append(parse_rppa(f))
-            elif "seg" in name:
-                parsed = parse_seg(f)
+            cache_dir.mkdir(exist_ok=True)
+        except OSError as e:
+            print(f"Parse cache disabled, cannot create {cache_dir}: {e}")
+            use_cache = False
+
+    def parse_file(cat: str, f: Path) -> SampleFeatures | None:
+        if use_cache:
+            return parse_cached(parsers[cat], f, cache_dir)
+        return parsers[cat](f)
+
+    # pyarrow releases the GIL while tokenizing, so threads parse files
+    # concurrently. Results are gathered in submission order to keep the
+    # sample order deterministic.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = [
+            ex.submit(parse_file, cat, paths[0])
+            for (cat, _), paths in candidates.items()
+        ]
+        for ((cat, _), paths), fut in zip(candidates.items(), futures):
+            for i, f in enumerate(paths):
+                try:
+                    parsed = fut.result() if i == 0 else parse_file(cat, f)
+                except Exception as e:
+                    print(f"Failed to parse {f}: {e}")
+                    continue
                 if parsed is not None:
-                    seg_frames.append(parsed)
-        except Exception as e:
-            print(f"Failed to parse {f}: {e}")
+                    buckets[cat].append(parsed)
+                    break
 
     combined = []
-    if mirna_frames:
-        mirna_concat = pd.concat(mirna_frames, axis=0, sort=False)
-        mirna_concat = mirna_concat[~mirna_concat.index.duplicated(keep="first")]
-        combined.append(mirna_concat)
-        print(f"Loaded miRNA samples: {len(mirna_concat)}")
-
-    if rppa_frames:
-        rppa_concat = pd.concat(rppa_frames, axis=0, sort=False)
-        rppa_concat = rppa_concat[~rppa_concat.index.duplicated(keep="first")]
-        combined.append(rppa_concat)
-        print(f"Loaded RPPA samples: {len(rppa_concat)}")
-
-    if seg_frames:
-        seg_concat = pd.concat(seg_frames, axis=0, sort=False)
-        seg_concat = seg_concat[~seg_concat.index.duplicated(keep="first")]
-        combined.append(seg_concat)
-        print(f"Loaded segmentation samples: {len(seg_concat)}")
+    if mirna_records:
+        mirna_wide = pivot_samples(mirna_records)
+        combined.append(mirna_wide)
+        print(f"Loaded miRNA samples: {len(mirna_wide)}")
+
+    if rppa_records:
+        rppa_wide = pivot_samples(rppa_records)
+        combined.append(rppa_wide)
+        print(f"Loaded RPPA samples: {len(rppa_wide)}")
+
+    if seg_records:
+        seg_wide = pivot_samples(seg_records)
+        combined.append(seg_wide)
+        print(f"Loaded segmentation samples: {len(seg_wide)}")
 
     if not combined:
         return pd.DataFrame()
 
-    final = pd.concat(combined, axis=1, sort=False).fillna(0)
+    final = pd.concat(combined, axis=1, sort=False).astype(np.float32).fillna(0)
     final.index.name = "sample_id"
     return final
 
@@ -145,14 +342,27 @@ def main():
     parser.add_argument(
         "--output", type=Path,
         default=Path(__file__).resolve().parent / 'crc_consolidated.csv',
-        help="Path for the consolidated CSV output",
+        help="Path for the consolidated output (.csv, or .parquet for Parquet)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Re-parse every file instead of using the Parquet parse cache",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true",
+        help="List every matched data file before parsing",
     )
     args = parser.parse_args()
 
-    data = collect_data(args.data_dir)
+    data = collect_data(
+        args.data_dir, use_cache=not args.no_cache, verbose=args.verbose
+    )
     if not data.empty:
         args.output.parent.mkdir(parents=True, exist_ok=True)
-        data.to_csv(args.output)
+        if args.output.suffix.lower() == ".parquet":
+            data.to_parquet(args.output, compression="zstd")
+        else:
+            data.to_csv(args.output, chunksize=10000, float_format="%.7g")
         print(f"Consolidated data written to {args.output}")
     else:
         print('No data parsed. Nothing was written.')
@@ -29,7 +29,10 @@ import pennylane as qml
 
 def load_crc_csv(csv_path: Path) -> torch.Tensor:
     """Load multi-omic data saved by crcClean.py and return as tensor."""
-    df = pd.read_csv(csv_path, index_col=0)
+    if csv_path.suffix.lower() == ".parquet":
+        df = pd.read_parquet(csv_path)
+    else:
+        df = pd.read_csv(csv_path, index_col=0)
     data = df.to_numpy(dtype=np.float32)
     return torch.from_numpy(data)
 